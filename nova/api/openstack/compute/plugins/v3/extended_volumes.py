@@ -15,6 +15,11 @@
 #   under the License.
 
 """The Extended Volumes API extension."""
+import re
+import sys
+
+from eventlet import event
+from oslo.config import cfg
 from webob import exc
 
 from nova.api.openstack import common
@@ -24,16 +29,48 @@ from nova.api.openstack import xmlutil
 from nova import compute
 from nova import exception
 from nova.openstack.common import log as logging
-from nova.openstack.common import uuidutils
 from nova import volume
 
+opts = [
+    cfg.IntOpt('osapi_max_concurrent_attaches_per_instance',
+               default=0,
+               help='Maximum number of volume attach requests handled '
+                    'concurrently for a single instance by each API '
+                    'worker. Further requests are rejected with 503 '
+                    'until one completes. 0 means no limit.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
 ALIAS = "os-extended-volumes"
+_VOLUMES_ATTACHED_KEY = "%s:volumes_attached" % ALIAS
 LOG = logging.getLogger(__name__)
+# Canonical UUID form, as accepted by uuidutils.is_uuid_like()
+_UUID_RE = re.compile(r'\A[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                      r'[0-9a-f]{4}-[0-9a-f]{12}\Z')
+_uuid_match = _UUID_RE.match
+
+_BAD_UUID_TMPL = _("Bad volumeId format: volumeId is not in proper format "
+                   "(%s)")
+_BAD_DEVICE_TMPL = _("Bad device format: device is not a string (%s)")
+_NOT_ATTACHED_TMPL = _("Volume %(volume_id)s is not attached to the "
+                       "instance %(server_id)s")
+_ATTACH_AUDIT_TMPL = _("Attach volume %(volume_id)s to instance %(server_id)s "
+                       "at %(device)s")
+_DETACH_AUDIT_TMPL = _("Detach volume %(volume_id)s from "
+                       "instance %(server_id)s")
+_TOO_MANY_ATTACHES_TMPL = _("Too many volume attachments are in progress for "
+                            "instance %s, please retry later")
+
 authorize = extensions.soft_extension_authorizer('compute', 'v3:' + ALIAS)
 authorize_attach = extensions.soft_extension_authorizer('compute',
                                                         'v3:%s:attach' % ALIAS)
 authorize_detach = extensions.soft_extension_authorizer('compute',
                                                         'v3:%s:detach' % ALIAS)
+# Sent to the callers waiting on a call whose greenthread was killed, to
+# make them run the call themselves.
+_RETRY = object()
 
 
 class ExtendedVolumesController(wsgi.Controller):
@@ -41,44 +78,130 @@ class ExtendedVolumesController(wsgi.Controller):
         super(ExtendedVolumesController, self).__init__(*args, **kwargs)
         self.compute_api = compute.API()
         self.volume_api = volume.API()
-
-    def _extend_server(self, context, server, instance):
-        bdms = self.compute_api.get_instance_bdms(context, instance)
-        volume_ids = [bdm['volume_id'] for bdm in bdms if bdm['volume_id']]
-        key = "%s:volumes_attached" % ExtendedVolumes.alias
-        server[key] = [{'id': volume_id} for volume_id in volume_ids]
+        # Events of the attach/detach calls currently being executed,
+        # keyed by _inflight_key().
+        self._inflight = {}
+        # Number of attach calls in progress, keyed by instance uuid.
+        self._attach_inflight = {}
+
+    def _inflight_key(self, context, action, *args):
+        # Only calls made with the same credentials may share a result,
+        # since compute_api.get() checks policy against the caller.
+        return ((action, context.user_id, context.project_id,
+                 context.is_admin, tuple(context.roles)) + args)
+
+    def _run_once(self, key, func, *args, **kwargs):
+        """Run func, or wait for an identical call that is in progress.
+
+        Concurrent duplicate requests share the result (or exception)
+        of the first one instead of each hitting compute and cinder.
+        func should only raise nova exceptions; each caller converts
+        them into its own HTTP error, because webob exceptions carry
+        per-request response state.
+        No lock is needed between the lookup and the insert below since
+        greenthreads only switch on I/O.
+        """
+        done = self._inflight.get(key)
+        if done is not None:
+            result = done.wait()
+            if result is not _RETRY:
+                return result
+            return self._run_once(key, func, *args, **kwargs)
+
+        done = event.Event()
+        self._inflight[key] = done
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            done.send_exception(*sys.exc_info())
+            raise
+        else:
+            done.send(result)
+            return result
+        finally:
+            del self._inflight[key]
+            if not done.ready():
+                # Killed by GreenletExit or an eventlet Timeout, so
+                # nothing was sent; do not leave the waiters blocked.
+                done.send(_RETRY)
+
+    def _cached_get_bdms(self, req, context, instance):
+        """Get the bdms of an instance, at most once per API request."""
+        cache = req.environ.setdefault('nova.bdm_cache', {})
+        key = instance['uuid']
+        if key not in cache:
+            cache[key] = self.compute_api.get_instance_bdms(context, instance)
+        return cache[key]
+
+    def _extend_server(self, context, server, bdms):
+        server[_VOLUMES_ATTACHED_KEY] = [{'id': bdm['volume_id']}
+                                         for bdm in bdms if bdm['volume_id']]
 
     @wsgi.extends
     def show(self, req, resp_obj, id):
         context = req.environ['nova.context']
         if authorize(context):
             # Attach our slave template to the response object
-            resp_obj.attach(xml=ExtendedVolumesServerTemplate())
+            resp_obj.attach(xml=_SHOW_TEMPLATE)
             server = resp_obj.obj['server']
             db_instance = req.get_db_instance(server['id'])
             # server['id'] is guaranteed to be in the cache due to
             # the core API adding it in its 'show' method.
-            self._extend_server(context, server, db_instance)
+            bdms = self._cached_get_bdms(req, context, db_instance)
+            self._extend_server(context, server, bdms)
 
     @wsgi.extends
     def detail(self, req, resp_obj):
         context = req.environ['nova.context']
         if authorize(context):
             # Attach our slave template to the response object
-            resp_obj.attach(xml=ExtendedVolumesServersTemplate())
-            servers = list(resp_obj.obj['servers'])
+            resp_obj.attach(xml=_DETAIL_TEMPLATE)
+            servers = resp_obj.obj['servers']
+            # Fetch the bdms of every server on the page with a single
+            # query rather than one round trip per server.
+            uuids = [server['id'] for server in servers]
+            bdms_by_uuid = self.compute_api.get_instance_bdms_by_uuids(
+                context, uuids)
             for server in servers:
-                db_instance = req.get_db_instance(server['id'])
-                # server['id'] is guaranteed to be in the cache due to
-                # the core API adding it in its 'detail' method.
-                self._extend_server(context, server, db_instance)
+                self._extend_server(context, server,
+                                    bdms_by_uuid[server['id']])
 
     def _validate_volume_id(self, volume_id):
-        if not uuidutils.is_uuid_like(volume_id):
-            msg = _("Bad volumeId format: volumeId is "
-                    "not in proper format (%s)") % volume_id
+        if (not isinstance(volume_id, basestring) or
+                not _uuid_match(volume_id)):
+            msg = _BAD_UUID_TMPL % volume_id
+            raise exc.HTTPBadRequest(explanation=msg)
+
+    def _validate_device(self, device):
+        if device is not None and not isinstance(device, basestring):
+            msg = _BAD_DEVICE_TMPL % device
             raise exc.HTTPBadRequest(explanation=msg)
 
+    def _attach(self, context, server_id, volume_id, device):
+        self._attach_inflight[server_id] = (
+            self._attach_inflight.get(server_id, 0) + 1)
+        try:
+            instance = self.compute_api.get(context, server_id)
+            self.compute_api.attach_volume(context, instance,
+                                           volume_id, device)
+        finally:
+            self._attach_inflight[server_id] -= 1
+            if not self._attach_inflight[server_id]:
+                del self._attach_inflight[server_id]
+
+    def _detach(self, req, context, server_id, volume_id):
+        instance = self.compute_api.get(context, server_id)
+        bdms = self._cached_get_bdms(req, context, instance)
+        bdm = next((bdm for bdm in bdms if bdm['volume_id'] == volume_id),
+                   None)
+        if bdm is None:
+            raise exception.VolumeUnattached(volume_id=volume_id)
+
+        # detach_volume checks the attach status of the volume, which only
+        # cinder knows, so look the volume up once a bdm references it.
+        volume = self.volume_api.get(context, volume_id)
+        self.compute_api.detach_volume(context, instance, volume)
+
     @wsgi.response(202)
     @wsgi.action('attach')
     def attach(self, req, id, body):
@@ -93,18 +216,28 @@ class ExtendedVolumesController(wsgi.Controller):
         device = body['attach'].get('device')
 
         self._validate_volume_id(volume_id)
+        self._validate_device(device)
 
-        LOG.audit(_("Attach volume %(volume_id)s to instance %(server_id)s "
-                    "at %(device)s"),
+        LOG.audit(_ATTACH_AUDIT_TMPL,
                   {'volume_id': volume_id,
                    'device': device,
                    'server_id': server_id},
                   context=context)
 
+        key = self._inflight_key(context, 'attach', server_id, volume_id,
+                                 device)
+        # A duplicate of an attach in progress only waits for it, so it
+        # does not count against the limit.
+        limit = CONF.osapi_max_concurrent_attaches_per_instance
+        if (limit and key not in self._inflight and
+                self._attach_inflight.get(server_id, 0) >= limit):
+            msg = _TOO_MANY_ATTACHES_TMPL % server_id
+            raise exc.HTTPServiceUnavailable(explanation=msg,
+                                             headers={'Retry-After': 1})
+
         try:
-            instance = self.compute_api.get(context, server_id)
-            self.compute_api.attach_volume(context, instance,
-                                           volume_id, device)
+            self._run_once(key, self._attach, context, server_id, volume_id,
+                           device)
         except (exception.InstanceNotFound, exception.VolumeNotFound) as e:
             raise exc.HTTPNotFound(explanation=e.format_message())
         except exception.InstanceInvalidState as state_error:
@@ -123,49 +256,35 @@ class ExtendedVolumesController(wsgi.Controller):
         authorize_detach(context)
 
         volume_id = body['detach']['volume_id']
-        LOG.audit(_("Detach volume %(volume_id)s from "
-                    "instance %(server_id)s"),
+        # Only the type is checked here: ids that are not uuids are left
+        # for cinder to report as not found.
+        if not isinstance(volume_id, basestring):
+            msg = _BAD_UUID_TMPL % volume_id
+            raise exc.HTTPBadRequest(explanation=msg)
+
+        LOG.audit(_DETACH_AUDIT_TMPL,
                   {"volume_id": volume_id,
-                   "server_id": id,
-                   "context": context})
-        try:
-            instance = self.compute_api.get(context, server_id)
-        except exception.InstanceNotFound as e:
-            raise exc.HTTPNotFound(explanation=e.format_message())
+                   "server_id": server_id},
+                  context=context)
 
+        key = self._inflight_key(context, 'detach', server_id, volume_id)
         try:
-            volume = self.volume_api.get(context, volume_id)
-        except exception.VolumeNotFound as e:
+            self._run_once(key, self._detach, req, context, server_id,
+                           volume_id)
+        except (exception.InstanceNotFound, exception.VolumeNotFound) as e:
             raise exc.HTTPNotFound(explanation=e.format_message())
-
-        bdms = self.compute_api.get_instance_bdms(context, instance)
-        if not bdms:
-            msg = _("Volume %(volume_id)s is not attached to the "
-                    "instance %(server_id)s") % {'server_id': server_id,
-                                                 'volume_id': volume_id}
+        except exception.VolumeUnattached:
+            # Either no bdm references the volume or the volume is not
+            # attached.  Treat it as NotFound.
+            msg = _NOT_ATTACHED_TMPL % {'server_id': server_id,
+                                        'volume_id': volume_id}
             LOG.debug(msg)
             raise exc.HTTPNotFound(explanation=msg)
-
-        for bdm in bdms:
-            if bdm['volume_id'] != volume_id:
-                continue
-            try:
-                self.compute_api.detach_volume(context, instance, volume)
-                break
-            except exception.VolumeUnattached:
-                # The volume is not attached.  Treat it as NotFound
-                # by falling through.
-                pass
-            except exception.InvalidVolume as e:
-                raise exc.HTTPBadRequest(explanation=e.format_message())
-            except exception.InstanceInvalidState as state_error:
-                common.raise_http_conflict_for_instance_invalid_state(
-                    state_error, 'detach_volume')
-        else:
-            msg = _("Volume %(volume_id)s is not attached to the "
-                    "instance %(server_id)s") % {'server_id': server_id,
-                                                 'volume_id': volume_id}
-            raise exc.HTTPNotFound(explanation=msg)
+        except exception.InvalidVolume as e:
+            raise exc.HTTPBadRequest(explanation=e.format_message())
+        except exception.InstanceInvalidState as state_error:
+            common.raise_http_conflict_for_instance_invalid_state(
+                state_error, 'detach_volume')
 
 
 class ExtendedVolumes(extensions.V3APIExtensionBase):
@@ -189,7 +308,7 @@ class ExtendedVolumes(extensions.V3APIExtensionBase):
 def make_server(elem):
     volumes = xmlutil.SubTemplateElement(
         elem, '{%s}volume_attached' % ExtendedVolumes.namespace,
-        selector='%s:volumes_attached' % ExtendedVolumes.alias)
+        selector=_VOLUMES_ATTACHED_KEY)
     volumes.set('id')
 
 
@@ -208,3 +327,9 @@ class ExtendedVolumesServersTemplate(xmlutil.TemplateBuilder):
         make_server(elem)
         return xmlutil.SlaveTemplate(root, 1, nsmap={
             ExtendedVolumes.alias: ExtendedVolumes.namespace})
+
+
+# Slave templates are never copied or modified once built, so a single
+# instance of each can be shared by all requests.
+_SHOW_TEMPLATE = ExtendedVolumesServerTemplate()
+_DETAIL_TEMPLATE = ExtendedVolumesServersTemplate()
@@ -2705,6 +2705,25 @@ class API(base.Base):
             return block_device.legacy_mapping(bdms)
         return bdms
 
+    def get_instance_bdms_by_uuids(self, context, instance_uuids,
+                                   legacy=True):
+        """Get all bdm tables for a list of instance uuids.
+
+        Returns a dict mapping each instance uuid to its list of bdms.
+        """
+        bdms_by_uuid = dict((uuid, []) for uuid in instance_uuids)
+        if not instance_uuids:
+            return bdms_by_uuid
+        bdms = self.db.block_device_mapping_get_all_by_instance_uuids(
+                context, instance_uuids)
+        for bdm in bdms:
+            bdms_by_uuid[bdm['instance_uuid']].append(bdm)
+        if legacy:
+            for uuid, instance_bdms in bdms_by_uuid.iteritems():
+                bdms_by_uuid[uuid] = block_device.legacy_mapping(
+                        instance_bdms)
+        return bdms_by_uuid
+
     def is_volume_backed_instance(self, context, instance, bdms):
         if not instance['image_ref']:
             return True
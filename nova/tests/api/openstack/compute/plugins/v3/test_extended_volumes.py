@@ -15,10 +15,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
 from lxml import etree
 import webob
 
 from nova.api.openstack.compute.plugins.v3 import extended_volumes
+from nova.api.openstack import wsgi
 from nova import compute
 from nova import exception
 from nova.objects import instance as instance_obj
@@ -41,7 +43,8 @@ def fake_compute_get_not_found(*args, **kwargs):
 
 
 def fake_compute_get_all(*args, **kwargs):
-    db_list = [fakes.stub_instance(1), fakes.stub_instance(2)]
+    db_list = [fakes.stub_instance(1, uuid=UUID1),
+               fakes.stub_instance(2, uuid=UUID2)]
     fields = instance_obj.INSTANCE_DEFAULT_FIELDS
     return instance_obj._make_instance_list(args[1],
                                             instance_obj.InstanceList(),
@@ -52,6 +55,12 @@ def fake_compute_get_instance_bdms(*args, **kwargs):
     return [{'volume_id': UUID1}, {'volume_id': UUID2}]
 
 
+def fake_compute_get_instance_bdms_by_uuids(self, context, instance_uuids):
+    bdms = {UUID1: [{'volume_id': UUID1}, {'volume_id': UUID2}],
+            UUID2: [{'volume_id': UUID3}]}
+    return dict((uuid, bdms[uuid]) for uuid in instance_uuids)
+
+
 def fake_attach_volume(self, context, instance, volume_id, device):
     pass
 
@@ -85,6 +94,10 @@ def fake_detach_volume_invalid_volume(self, context, instance, volume):
     raise exception.InvalidVolume(reason='')
 
 
+def fake_detach_volume_unattached(self, context, instance, volume):
+    raise exception.VolumeUnattached(volume_id=UUID1)
+
+
 def fake_volume_get(*args, **kwargs):
     pass
 
@@ -105,6 +118,8 @@ class ExtendedVolumesTest(test.TestCase):
         self.stubs.Set(compute.api.API, 'get_all', fake_compute_get_all)
         self.stubs.Set(compute.api.API, 'get_instance_bdms',
                        fake_compute_get_instance_bdms)
+        self.stubs.Set(compute.api.API, 'get_instance_bdms_by_uuids',
+                       fake_compute_get_instance_bdms_by_uuids)
         self.stubs.Set(volume.cinder.API, 'get', fake_volume_get)
         self.stubs.Set(compute.api.API, 'detach_volume', fake_detach_volume)
         self.stubs.Set(compute.api.API, 'attach_volume', fake_attach_volume)
@@ -142,18 +157,105 @@ class ExtendedVolumesTest(test.TestCase):
         self.assertEqual(exp_volumes, actual)
 
     def test_detail(self):
+        calls = []
+
+        def fake_get_instance_bdms(self, context, instance):
+            calls.append(instance['uuid'])
+            return []
+
+        # The bdms of every server must come from the single bulk lookup.
+        self.stubs.Set(compute.api.API, 'get_instance_bdms',
+                       fake_get_instance_bdms)
         url = '/v3/servers/detail'
         res = self._make_request(url)
 
         self.assertEqual(res.status_int, 200)
-        exp_volumes = [{'id': UUID1}, {'id': UUID2}]
-        for i, server in enumerate(self._get_servers(res.body)):
+        exp_volumes = {UUID1: [{'id': UUID1}, {'id': UUID2}],
+                       UUID2: [{'id': UUID3}]}
+        servers = self._get_servers(res.body)
+        self.assertEqual(2, len(servers))
+        for server in servers:
             if self.content_type == 'application/json':
                 actual = server.get('%svolumes_attached' % self.prefix)
             elif self.content_type == 'application/xml':
                 actual = [dict(elem.items()) for elem in
                           server.findall('%svolume_attached' % self.prefix)]
-            self.assertEqual(exp_volumes, actual)
+            self.assertEqual(exp_volumes[server.get('id')], actual)
+        self.assertEqual([], calls)
+
+    def test_show_gets_bdms_once_per_request(self):
+        calls = []
+
+        def fake_get_instance_bdms(self, context, instance):
+            calls.append(instance['uuid'])
+            return [{'volume_id': UUID1}]
+
+        self.stubs.Set(compute.api.API, 'get_instance_bdms',
+                       fake_get_instance_bdms)
+        req = fakes.HTTPRequestV3.blank('/servers/%s' % UUID1)
+        req.cache_db_instance(fakes.stub_instance(1, uuid=UUID1))
+        # Every hook that extends the same request shares its environ,
+        # so only the first one queries the bdms.
+        for i in range(2):
+            resp_obj = wsgi.ResponseObject({'server': {'id': UUID1}})
+            self.Controller.show(req, resp_obj, UUID1)
+            server = resp_obj.obj['server']
+            self.assertEqual([{'id': UUID1}],
+                             server[extended_volumes._VOLUMES_ATTACHED_KEY])
+        self.assertEqual([UUID1], calls)
+
+    def test_run_once_coalesces_concurrent_calls(self):
+        calls = []
+
+        def fake_call(value):
+            calls.append(value)
+            eventlet.sleep(0)
+            return value
+
+        threads = [eventlet.spawn(self.Controller._run_once, 'key',
+                                  fake_call, i) for i in range(3)]
+        self.assertEqual([0, 0, 0], [thread.wait() for thread in threads])
+        self.assertEqual([0], calls)
+        self.assertEqual({}, self.Controller._inflight)
+
+    def test_run_once_shares_exceptions(self):
+        def fake_call():
+            eventlet.sleep(0)
+            raise exception.InvalidVolume(reason='')
+
+        threads = [eventlet.spawn(self.Controller._run_once, 'key',
+                                  fake_call) for i in range(2)]
+        for thread in threads:
+            self.assertRaises(exception.InvalidVolume, thread.wait)
+        self.assertEqual({}, self.Controller._inflight)
+
+    def test_run_once_waiter_survives_killed_leader(self):
+        calls = []
+
+        def fake_call():
+            calls.append(None)
+            if len(calls) == 1:
+                eventlet.sleep(10)
+            return 'done'
+
+        leader = eventlet.spawn(self.Controller._run_once, 'key', fake_call)
+        eventlet.sleep(0)
+        waiter = eventlet.spawn(self.Controller._run_once, 'key', fake_call)
+        eventlet.sleep(0)
+        leader.kill()
+        with eventlet.Timeout(1):
+            self.assertEqual('done', waiter.wait())
+        self.assertEqual(2, len(calls))
+        self.assertEqual({}, self.Controller._inflight)
+
+    def test_inflight_key_depends_on_caller(self):
+        user1 = fakes.FakeRequestContext('fake_user', 'fake')
+        user2 = fakes.FakeRequestContext('other_user', 'fake')
+        admin = fakes.FakeRequestContext('fake_user', 'fake', is_admin=True)
+        keys = set(self.Controller._inflight_key(context, 'detach', UUID1,
+                                                 UUID2)
+                   for context in (user1, user2, admin))
+        self.assertEqual(3, len(keys))
 
     def test_detach(self):
         url = "/v3/servers/%s/action" % UUID1
@@ -166,6 +268,11 @@ class ExtendedVolumesTest(test.TestCase):
         res = self._make_request(url, {"detach": {"volume_id": UUID2}})
         self.assertEqual(res.status_int, 404)
 
+    def test_detach_with_non_string_vol(self):
+        url = "/v3/servers/%s/action" % UUID1
+        res = self._make_request(url, {"detach": {"volume_id": ["xxx"]}})
+        self.assertEqual(res.status_int, 400)
+
     def test_detach_with_non_existed_instance(self):
         url = "/v3/servers/%s/action" % UUID1
         self.stubs.Set(compute.api.API, 'get', fake_compute_get_not_found)
@@ -179,16 +286,107 @@ class ExtendedVolumesTest(test.TestCase):
         res = self._make_request(url, {"detach": {"volume_id": UUID2}})
         self.assertEqual(res.status_int, 400)
 
+    def test_detach_with_not_attached_vol(self):
+        url = "/v3/servers/%s/action" % UUID1
+        res = self._make_request(url, {"detach": {"volume_id": UUID3}})
+        self.assertEqual(res.status_int, 404)
+
+    def test_detach_with_not_attached_vol_skips_volume_get(self):
+        url = "/v3/servers/%s/action" % UUID1
+        self.stubs.Set(volume.cinder.API, 'get', fake_volume_get_not_found)
+        res = self._make_request(url, {"detach": {"volume_id": UUID3}})
+        self.assertEqual(res.status_int, 404)
+        self.assertIn('is not attached', res.body)
+
+    def test_detach_with_duplicate_bdms(self):
+        calls = []
+
+        def fake_get_instance_bdms(*args, **kwargs):
+            return [{'volume_id': UUID1}, {'volume_id': UUID1}]
+
+        def fake_detach_volume(self, context, instance, volume):
+            calls.append(volume)
+            raise exception.VolumeUnattached(volume_id=UUID1)
+
+        self.stubs.Set(compute.api.API, 'get_instance_bdms',
+                       fake_get_instance_bdms)
+        self.stubs.Set(compute.api.API, 'detach_volume', fake_detach_volume)
+        url = "/v3/servers/%s/action" % UUID1
+        res = self._make_request(url, {"detach": {"volume_id": UUID1}})
+        self.assertEqual(res.status_int, 404)
+        self.assertEqual(1, len(calls))
+
+    def test_detach_with_unattached_vol(self):
+        url = "/v3/servers/%s/action" % UUID1
+        self.stubs.Set(compute.api.API, 'detach_volume',
+                       fake_detach_volume_unattached)
+        res = self._make_request(url, {"detach": {"volume_id": UUID1}})
+        self.assertEqual(res.status_int, 404)
+
     def test_attach_volume(self):
         url = "/v3/servers/%s/action" % UUID1
         res = self._make_request(url, {"attach": {"volume_id": UUID1}})
         self.assertEqual(res.status_int, 202)
 
+    def _attach_body(self, volume_id=UUID2):
+        return {'attach': {'volume_id': volume_id}}
+
+    def test_attach_volume_over_concurrency_limit(self):
+        self.flags(osapi_max_concurrent_attaches_per_instance=1)
+        self.Controller._attach_inflight[UUID1] = 1
+        req = fakes.HTTPRequestV3.blank('/servers/%s/action' % UUID1)
+        self.assertRaises(webob.exc.HTTPServiceUnavailable,
+                          self.Controller.attach, req, UUID1,
+                          self._attach_body())
+        self.assertEqual({UUID1: 1}, self.Controller._attach_inflight)
+
+    def test_attach_volume_releases_concurrency_slot(self):
+        self.flags(osapi_max_concurrent_attaches_per_instance=1)
+        req = fakes.HTTPRequestV3.blank('/servers/%s/action' % UUID1)
+        self.Controller.attach(req, UUID1, self._attach_body())
+        self.stubs.Set(compute.api.API, 'attach_volume',
+                       fake_attach_volume_invalid_volume)
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.Controller.attach, req, UUID1,
+                          self._attach_body())
+        self.assertEqual({}, self.Controller._attach_inflight)
+
     def test_attach_volume_with_bad_id(self):
         url = "/v3/servers/%s/action" % UUID1
         res = self._make_request(url, {"attach": {"volume_id": 'xxx'}})
         self.assertEqual(res.status_int, 400)
 
+    def test_attach_volume_with_non_string_id(self):
+        url = "/v3/servers/%s/action" % UUID1
+        res = self._make_request(url, {"attach": {"volume_id": 1}})
+        self.assertEqual(res.status_int, 400)
+
+    def test_attach_volume_with_non_string_device(self):
+        url = "/v3/servers/%s/action" % UUID1
+        res = self._make_request(url, {"attach": {"volume_id": UUID1,
+                                                  'device': ['xxx']}})
+        self.assertEqual(res.status_int, 400)
+
+    def test_attach_volume_coalesced_requests_get_own_errors(self):
+        def fake_attach_volume(self, context, instance, volume_id, device):
+            eventlet.sleep(0)
+            raise exception.InvalidVolume(reason='')
+
+        self.stubs.Set(compute.api.API, 'attach_volume', fake_attach_volume)
+
+        def do_attach():
+            req = fakes.HTTPRequestV3.blank('/servers/%s/action' % UUID1)
+            try:
+                self.Controller.attach(req, UUID1, self._attach_body())
+            except webob.exc.HTTPBadRequest as e:
+                return e
+
+        threads = [eventlet.spawn(do_attach) for i in range(2)]
+        errors = [thread.wait() for thread in threads]
+        self.assertTrue(all(isinstance(e, webob.exc.HTTPBadRequest)
+                            for e in errors))
+        self.assertIsNot(errors[0], errors[1])
+
     def test_attach_volume_with_non_existe_vol(self):
         url = "/v3/servers/%s/action" % UUID1
         self.stubs.Set(compute.api.API, 'attach_volume',
@@ -8255,6 +8255,31 @@ class ComputeAPITestCase(BaseTestCase):
         self.assertEqual(expected,
                          self.compute_api.get_instance_bdms({}, instance))
 
+    def test_get_instance_bdms_by_uuids(self):
+        bdms = [{'instance_uuid': 'fake-uuid1', 'volume_id': 'vol1'},
+                {'instance_uuid': 'fake-uuid1', 'volume_id': 'vol2'},
+                {'instance_uuid': 'fake-uuid2', 'volume_id': 'vol3'}]
+        self.mox.StubOutWithMock(self.compute_api.db,
+                       'block_device_mapping_get_all_by_instance_uuids')
+        self.compute_api.db.\
+            block_device_mapping_get_all_by_instance_uuids(
+                mox.IgnoreArg(),
+                ['fake-uuid1', 'fake-uuid2', 'fake-uuid3']).AndReturn(bdms)
+        self.mox.ReplayAll()
+
+        result = self.compute_api.get_instance_bdms_by_uuids(
+            {}, ['fake-uuid1', 'fake-uuid2', 'fake-uuid3'], legacy=False)
+        self.assertEqual({'fake-uuid1': bdms[:2],
+                          'fake-uuid2': bdms[2:],
+                          'fake-uuid3': []}, result)
+
+    def test_get_instance_bdms_by_uuids_empty(self):
+        self.mox.StubOutWithMock(self.compute_api.db,
+                       'block_device_mapping_get_all_by_instance_uuids')
+        self.mox.ReplayAll()
+        self.assertEqual({}, self.compute_api.get_instance_bdms_by_uuids({},
+                                                                         []))
+
 
 def fake_rpc_method(context, topic, msg, do_cast=True):
     pass